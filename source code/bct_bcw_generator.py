@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Joint extraction of the flow (bct) and wave (bcw) boundary conditions
+Both boundary csv files are converted to geographic coordinates once,
+points shared by flow and wave boundaries are interpolated once and
+flow and wave share the interpolation weights when their grids are identical
+The output files are the same as from the separate bct and bcw generators
+"""
+
+# %% Over head function
+
+
+def bct_bcw_file_generator(boundaries, boundaries_wave, nc_file, nc_file_wave, mdf_file, mdw_file,
+                           step, step_wave, bct_file_name, bcw_file_name, time_chunk=None,
+                           max_gap=None, workers=None, executor='thread'):
+
+    # %% Import packages
+    import os
+    import extract_from_d3d_files
+    import extraction_methods
+    import bct_generator
+    import bcw_generator
+
+    try:
+        import xarray as xr
+    except ModuleNotFoundError as err_4:
+        # Error handling
+        print(
+            str(err_4) +
+            ' This package also requires extra dependencies like netCDF4, h5netcdf and possibly scipy')
+
+    # %% Simulation time frame from the mdf file, shared by flow and wave
+    start, stop, reference_time, start_time, end_time = extract_from_d3d_files.mdf_time_frame(
+        mdf_file)
+    print(".")
+    # %% Boundary locations and interpolation weights, computed once for both
+
+    locations = extraction_methods.boundary_locations(boundaries, 'bct')
+    locations_wave = extraction_methods.boundary_locations(boundaries_wave, 'bcw')
+
+    stencil_cache = '{}_joint_stencil.npz'.format(os.path.splitext(boundaries)[0])
+    with xr.open_dataset(nc_file) as data, xr.open_dataset(nc_file_wave) as data_wave:
+        stencil, stencil_wave = extraction_methods.shared_stencils(
+            [data, data_wave], [locations, locations_wave], cache_file=stencil_cache)
+    print(".")
+    # %% Create the bct file
+
+    bct_generator.bct_file_generator(
+        boundaries=boundaries, nc_file=nc_file, mdf_file=mdf_file, step=step,
+        bct_file_name=bct_file_name, time_chunk=time_chunk, max_gap=max_gap,
+        workers=workers, executor=executor,
+        locations=locations, stencil=stencil)
+    print('The process of extracting water level has now completed')
+
+    # %% Create the bcw file
+
+    bcw_generator.bcw_file_generator(
+        boundaries_wave=boundaries_wave, nc_file_wave=nc_file_wave, mdw_file=mdw_file,
+        start_time=start_time, end_time=end_time, step_wave=step_wave, bcw_file_name=bcw_file_name,
+        time_chunk=time_chunk, max_gap=max_gap, workers=workers, executor=executor,
+        locations=locations_wave, stencil=stencil_wave)
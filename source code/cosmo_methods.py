@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Shared methods for the COSMO wind and pressure field generator
+The COSMO points are triangulated once and the linear interpolation onto the
+Delft3D grid is stored as a sparse operator that is applied to every field.
+GRIB files are cropped to the COSMO window before their values are read and a
+catalogue of their times decides which files a run needs. Upcoming files can be
+read ahead in a thread pool while the current one is regridded and written, or
+whole months are regridded in a process pool into segments that are merged in order.
+Regridded fields are cached in compressed NetCDF files, so a new reference time or
+output name only formats the fields again.
+"""
+import os
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import output_methods
+
+try:
+    from scipy.spatial import Delaunay
+    from scipy import sparse
+except ModuleNotFoundError as err:
+    # Error handling
+    print(str(err) + ' Module scipy is needed to regrid the COSMO fields')
+
+try:
+    import xarray as xr
+except ModuleNotFoundError as err:
+    # Error handling
+    print(str(err) + ' This package also requires extra dependencies like netCDF4')
+
+try:
+    import cfgrib
+except ModuleNotFoundError as err:
+    # Error handling
+    print(str(err) + ' Module cfgrib is needed to read the COSMO GRIB files,',
+          'conda code: conda install -c conda-forge cfgrib')
+
+
+NODATA_VALUE = 9999.00  # fill value of the meteo_on_equidistant_grid files
+GRIB_INDEX_DIR = 'grib_index'  # folder in the COSMO directory that keeps the cfgrib index files
+GRIB_CATALOGUE = 'grib_catalogue.csv'  # catalogue of the GRIB files, kept in the index folder
+REGRID_CACHE_DIR = 'regridded'  # folder in the index folder with the cached regridded fields
+COSMO_FOLDERS = ['UV', 'PS']
+COSMO_VARIABLES = ['u10', 'v10', 'sp']  # U, V and PS short names in the GRIB files
+# field written to every output file, the wind files repeat the U and V fields
+METEO_STREAMS = {'amu': 'U', 'amv': 'V', 'amp': 'P', 'xwind': 'U', 'ywind': 'V'}
+
+
+def open_grib(grib_file, index_dir=None):
+    """Open a COSMO GRIB file lazily with cfgrib.
+
+    If index_dir is given the cfgrib index of the file is kept there and reused by later
+    runs, cfgrib rebuilds it when the GRIB file is newer than the index."""
+    if index_dir is None:
+        return cfgrib.open_dataset(grib_file)
+    os.makedirs(index_dir, exist_ok=True)
+    indexpath = os.path.join(index_dir, os.path.basename(grib_file) + '.{short_hash}.idx')
+    return cfgrib.open_dataset(grib_file, indexpath=indexpath)
+
+
+def grib_catalogue(cosmo_dir, index_dir):
+    """Catalogue of the GRIB files in the UV and PS folders of the COSMO directory.
+
+    Holds per file its variable and the first and last time step. The catalogue is kept as
+    a csv file in index_dir and only new or changed files (size or modification time) are
+    opened again, which reads their cfgrib index but no values."""
+    catalogue_file = os.path.join(index_dir, GRIB_CATALOGUE)
+    columns = ['file', 'variable', 'first_time', 'last_time', 'n_times', 'size', 'mtime']
+    known = {}
+    if os.path.isfile(catalogue_file):
+        for row in pd.read_csv(catalogue_file).itertuples(index=False):
+            known[row.file] = row
+
+    rows = []
+    for folder in COSMO_FOLDERS:
+        for name in sorted(os.listdir(os.path.join(cosmo_dir, folder))):
+            if not name.endswith('.grb'):
+                continue
+            grib_file = os.path.join(folder, name)
+            path = os.path.join(cosmo_dir, grib_file)
+            stat = os.stat(path)
+            size, mtime = stat.st_size, stat.st_mtime_ns
+
+            row = known.get(grib_file)
+            if row is None or row.size != size or row.mtime != mtime:
+                with open_grib(path, index_dir) as ds:
+                    times = np.atleast_1d(ds.time.values).astype('datetime64[s]')
+                    variable = list(ds.data_vars)[0]
+                row = (grib_file, variable, str(times[0]), str(times[-1]), len(times), size, mtime)
+            rows.append(tuple(row))
+
+    catalogue = pd.DataFrame(rows, columns=columns)
+    os.makedirs(index_dir, exist_ok=True)
+    catalogue.to_csv(catalogue_file, index=False)
+    catalogue['first_time'] = pd.to_datetime(catalogue['first_time'])
+    catalogue['last_time'] = pd.to_datetime(catalogue['last_time'])
+    return catalogue
+
+
+def select_grib_files(catalogue, start_time=None, end_time=None):
+    """U, V and PS files that overlap the time window, matched by their time range.
+
+    Returns (u file, v file, ps file) tuples in time order, paths relative to the COSMO
+    directory. Time ranges that miss one of the components are skipped with a message."""
+    window = catalogue
+    if start_time is not None:
+        window = window[window['last_time'] >= pd.Timestamp(start_time)]
+    if end_time is not None:
+        window = window[window['first_time'] <= pd.Timestamp(end_time)]
+
+    by_variable = {}
+    for variable in COSMO_VARIABLES:
+        files = window[window['variable'] == variable]
+        files = files.drop_duplicates(['first_time', 'last_time'])
+        by_variable[variable] = files.set_index(['first_time', 'last_time'])['file']
+
+    ranges = set().union(*(files.index for files in by_variable.values()))
+    triplets = []
+    for time_range in sorted(ranges):
+        if all(time_range in files.index for files in by_variable.values()):
+            triplets.append(tuple(by_variable[variable][time_range]
+                                  for variable in COSMO_VARIABLES))
+        else:
+            print(f'No complete U, V and PS set from {time_range[0]} to {time_range[1]}, skipped')
+
+    return triplets
+
+
+def read_window(variable, window):
+    """Cropped (time, mm, nn) cube of a COSMO variable shaped (time, lat, lon).
+
+    The window (mm1, mm2, nn1, nn2) indexes the transposed fields. It is applied to the lazy
+    variable so only the sub-block of every field is kept in memory, not the whole domain."""
+    mm1, mm2, nn1, nn2 = window
+    return variable[:, nn1:nn2, mm1:mm2].values.transpose(0, 2, 1)
+
+
+def linear_operator(xcos, ycos, X, Y):
+    """Sparse linear interpolation operator from the COSMO points to the grid points.
+
+    Gives the same result as griddata(method='linear'): the grid points are located in the
+    Delaunay triangulation of the COSMO points once and their barycentric weights become
+    the rows of a (grid point, COSMO point) matrix. Grid points outside the convex hull or
+    without coordinates are flagged in 'inside' and get no weights."""
+    source = np.column_stack([np.ravel(xcos), np.ravel(ycos)]).astype('float64')
+    target = np.column_stack([np.ravel(X), np.ravel(Y)]).astype('float64')
+
+    tri = Delaunay(source)
+    simplex = tri.find_simplex(target)
+    inside = simplex >= 0
+
+    # barycentric coordinates from the affine transform of every containing triangle
+    transform = tri.transform[simplex[inside]]
+    bary = np.einsum('nij,nj->ni', transform[:, :2], target[inside] - transform[:, 2])
+    weights = np.column_stack([bary, 1 - bary.sum(axis=1)])
+
+    rows = np.repeat(np.flatnonzero(inside), 3)
+    cols = tri.simplices[simplex[inside]].ravel()
+    matrix = sparse.csr_matrix((weights.ravel(), (rows, cols)),
+                               shape=(len(target), len(source)))
+
+    return {'matrix': matrix, 'inside': inside, 'shape': np.shape(X)}
+
+
+def regrid_cube(operator, cube, scale=1):
+    """Interpolate a (time, mm, nn) cube of COSMO fields onto the grid in one sparse
+    matrix product, all time steps at once.
+
+    Returns an array shaped (time, grid rows, grid columns) divided by scale, with the
+    NODATA value outside the COSMO domain."""
+    cube = np.asarray(cube, dtype='float64')
+    n_time = cube.shape[0]
+    values = (operator['matrix'] @ cube.reshape(n_time, -1).T).T
+    if scale != 1:
+        values = values / scale
+    values[:, ~operator['inside']] = NODATA_VALUE
+    values[np.isnan(values)] = NODATA_VALUE
+    return values.reshape((n_time,) + tuple(operator['shape']))
+
+
+def meteo_fields(operator, wnd_cosu, wnd_cosv, ps_cos):
+    """U, V and pressure in mbar on the grid, each component regridded in one matrix product."""
+    return {'U': regrid_cube(operator, wnd_cosu),
+            'V': regrid_cube(operator, wnd_cosv),
+            'P': regrid_cube(operator, ps_cos, scale=100)}
+
+
+def meteo_time_lines(times, ref_time):
+    """TIME header of every step in whole hours since the reference datetime."""
+    time_lines = []
+    for T in np.asarray(times).astype('datetime64[s]').tolist():
+        diff = round((T - ref_time).total_seconds() / 3600)
+        time_lines.append(
+            f'TIME = {diff} hours since {ref_time.strftime("%Y-%m-%d %H:%M:%S")} +00:00 ')
+    return time_lines
+
+
+def read_triplet(cosmo_dir, triplet, index_dir, window, start_time=None, end_time=None):
+    """Read one (u file, v file, ps file) set inside the time window.
+
+    Returns the time steps of the U file and the cropped (time, mm, nn) cubes of U, V and PS."""
+    cubes = []
+    for grib_file, variable in zip(triplet, COSMO_VARIABLES):
+        with open_grib(os.path.join(cosmo_dir, grib_file), index_dir) as ds:
+            ds = ds.sel(time=slice(start_time, end_time))
+            if not cubes:
+                times = ds.time.values.astype('datetime64[s]')
+            cubes.append(read_window(ds[variable], window))
+
+    return (times, *cubes)
+
+
+def grid_key(X, Y, xcos, ycos, window):
+    """Hash of the target grid, the COSMO coordinates and the crop window."""
+    digest = hashlib.sha1()
+    for arr in [X, Y, xcos, ycos, window]:
+        digest.update(np.ascontiguousarray(arr, dtype='float64').tobytes())
+    return digest.hexdigest()
+
+
+def regrid_cache_file(cosmo_dir, triplet, index_dir, key):
+    """Cache file of the regridded fields of one (u file, v file, ps file) set, named after
+    the grid key and the names, sizes and modification times of the GRIB files."""
+    digest = hashlib.sha1(key.encode())
+    for grib_file in triplet:
+        stat = os.stat(os.path.join(cosmo_dir, grib_file))
+        digest.update(f'{grib_file}|{stat.st_size}|{stat.st_mtime_ns}'.encode())
+    return os.path.join(index_dir, REGRID_CACHE_DIR, digest.hexdigest()[:16] + '.nc')
+
+
+def save_fields(cache_file, times, fields):
+    """Store regridded fields shaped (time, grid rows, grid columns) in a NetCDF file,
+    compressed and chunked by day."""
+    n_time, n_rows, n_cols = fields['U'].shape
+    ds = xr.Dataset({name: (('time', 'row', 'col'), values) for name, values in fields.items()},
+                    coords={'time': times})
+    encoding = {name: {'zlib': True, 'complevel': 4, 'shuffle': True,
+                       'chunksizes': (max(min(n_time, 24), 1), n_rows, n_cols)}
+                for name in fields}
+    temp_file = cache_file + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        ds.to_netcdf(temp_file, encoding=encoding)
+        os.replace(temp_file, cache_file)
+    except (OSError, ValueError, RuntimeError) as err:
+        print('Regridded fields could not be cached: {}'.format(err))
+
+
+def load_fields(cache_file):
+    """Cached time steps and regridded fields, returns None if missing or unreadable."""
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with xr.open_dataset(cache_file) as ds:
+            return ds.time.values, {name: ds[name].values for name in ['U', 'V', 'P']}
+    except (OSError, ValueError, KeyError, RuntimeError):
+        return None
+
+
+def regridded_triplet(cosmo_dir, triplet, index_dir, window, operator, key=None,
+                      start_time=None, end_time=None):
+    """Time steps and regridded U, V and P of one (u file, v file, ps file) set inside the
+    time window.
+
+    With a grid key the fields of the whole files are cached, and later runs on the same grid
+    and GRIB files read them back instead of decoding and regridding again."""
+    if key is None:
+        times, wnd_cosu, wnd_cosv, ps_cos = read_triplet(
+            cosmo_dir, triplet, index_dir, window, start_time, end_time)
+        return times, meteo_fields(operator, wnd_cosu, wnd_cosv, ps_cos)
+
+    cache_file = regrid_cache_file(cosmo_dir, triplet, index_dir, key)
+    cached = load_fields(cache_file)
+    if cached is None:
+        times, wnd_cosu, wnd_cosv, ps_cos = read_triplet(cosmo_dir, triplet, index_dir, window)
+        cached = times, meteo_fields(operator, wnd_cosu, wnd_cosv, ps_cos)
+        save_fields(cache_file, *cached)
+
+    times, fields = cached
+    times = np.asarray(times).astype('datetime64[s]')
+    inside = np.ones(len(times), dtype=bool)
+    if start_time is not None:
+        inside &= times >= np.datetime64(start_time)
+    if end_time is not None:
+        inside &= times <= np.datetime64(end_time)
+    return times[inside], {name: values[inside] for name, values in fields.items()}
+
+
+def prefetch(function, jobs, workers=None):
+    """Results of function(*job) for every job, in job order.
+
+    With workers > 1 the next jobs run ahead in a thread pool while the caller works on the
+    current result. At most workers results exist at once, the one the caller holds included,
+    so the results read ahead are bounded."""
+    if workers is None or workers <= 1:
+        for job in jobs:
+            yield function(*job)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.submit(function, *job))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _segment_job(job):
+    """Regrid and format one (u file, v file, ps file) set into segment files of U, V and P.
+    Module level so it can be pickled for the process pool."""
+    ref_time, segment_file = job[-2:]
+    times, fields = regridded_triplet(*job[:-2])
+    blocks = output_methods.format_meteo_steps(
+        {name: name for name in fields}, meteo_time_lines(times, ref_time), fields)
+
+    segments = {}
+    for name, block in blocks.items():
+        segments[name] = f'{segment_file}_{name}.txt'
+        with open(segments[name], 'w') as f:
+            f.write(block)
+    return segments
+
+
+def segments_in_processes(jobs, workers=None):
+    """Segment files of every job from a process pool, yielded in job order as they finish,
+    so merging can start before the last months are done."""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(_segment_job, jobs)
@@ -1,109 +1,70 @@
 # -*- coding: utf-8 -*-
 """
 Converting COSMO files to Delft3D format
+Optionally only the GRIB files inside start_time / end_time are used
+With workers > 1 the next GRIB files are read on a thread pool, executor='process'
+regrids whole months on a process pool
+With cache=True the regridded fields are kept in <COSMO path>/grib_index/regridded as
+compressed NetCDF files (float64, U, V and P on the grid for every hour), so a new
+reference time or output name only formats again. Delete that folder to clear the cache
+
 """
 
 
 def create_wind_fields_cosmo(grid_ed_path, cosmo_db_utm_path, cosmo_files_path,
-                             file_name, ref_time):
+                             file_name, ref_time, start_time=None, end_time=None,
+                             workers=None, executor='thread', cache=False):
 
     import os
     import numpy as np
     import scipy.io
-    from scipy.interpolate import griddata
+    import tempfile
     import datetime as dt
-    import cfgrib
     from tqdm import tqdm
     import warnings
     # Suppress specific warning about ecCodes version
     warnings.filterwarnings(
         "ignore", message="ecCodes 2.31.0 or higher is recommended. You are running version 2.26.0")
+    import cosmo_methods
+    import output_methods
 
     # %% Functions
 
     # Function to process the COSMO data and write it to files
 
-    def process_data(year, cosmo_dir, X, Y, xcos, ycos, files, REF):
-        # List all UV and PS files in the COSMO directory
-        A = [f for f in os.listdir(os.path.join(
-            cosmo_dir, 'UV')) if f.endswith('.grb')]
-        B = [f for f in os.listdir(os.path.join(
-            cosmo_dir, 'PS')) if f.endswith('.grb')]
-
-        for i in tqdm(range(0, len(A) // 2), desc='Extracting wind and pressure fields', total=(len(A) // 2), leave=True, mininterval=0.1):
-            # Define file paths for U, V, and PS components
-            WU_file = os.path.join(cosmo_dir, 'UV/', 'U_' + A[i][2:])
-            WV_file = os.path.join(
-                cosmo_dir, 'UV/', 'V_' + A[i + len(A) // 2][2:])
-            PS_file = os.path.join(cosmo_dir, 'PS/', B[i])
-
-            # Open GRIB files using cfgrib
-            WU = cfgrib.open_dataset(WU_file)
-            WV = cfgrib.open_dataset(WV_file)
-            PS = cfgrib.open_dataset(PS_file)
-
-            for kk in range(len(WU.time)):
-                # Process U component
-                DATA_U = WU.u10.values[kk]
-                DATA_U = DATA_U.T
-                wnd_cosu = DATA_U[mm1:mm2, nn1:nn2]
-
-                U = griddata((xcos.flatten(), ycos.flatten()),
-                             wnd_cosu.flatten(), (X, Y), method='linear')
-                U[np.isnan(U)] = 9999.00
-
-                # Process V component
-                DATA_V = WV.v10.values[kk]
-                DATA_V = DATA_V.T
-                wnd_cosv = DATA_V[mm1:mm2, nn1:nn2]
-                V = griddata((xcos.flatten(), ycos.flatten()),
-                             wnd_cosv.flatten(), (X, Y), method='linear')
-                V[np.isnan(V)] = 9999.00
-
-                # Process pressure component
-                DATA_P = PS.sp.values[kk]
-                DATA_P = DATA_P.T
-                ps_cos = DATA_P[mm1:mm2, nn1:nn2]
-                P = griddata((xcos.flatten(), ycos.flatten()),
-                             ps_cos.flatten(), (X, Y), method='linear') / 100
-                P[np.isnan(P)] = 9999.00
-
-                # Calculate time difference and format time string
-                T = WU.time.values[kk].astype('datetime64[s]').tolist()
-                diff = round((T - REF).total_seconds() / 3600)
-                t = f'TIME = {diff} hours since {REF.strftime("%Y-%m-%d %H:%M:%S")} +00:00 '
-
-                # Write time header to files
-                for key in ['amu', 'amv', 'amp', 'xwind', 'ywind']:
-                    files[key].write(f'{t}\n')
-
-                # Write data to files
-                write_data(files['amu'], U, a, b)
-                write_data(files['amv'], V, a, b)
-                write_data(files['amp'], P, a, b, is_pressure=True)
-                write_data(files['xwind'], U, a, b)
-                write_data(files['ywind'], V, a, b)
-
-    def write_data(fid, data, a, b, is_pressure=False):
-        if is_pressure:
-            Fa = '%6.2f'
-            Fb = ' %7.2f'
-            Fc = ' %7.2f\n'
-        else:
-            Fa = '%6.2f'
-            Fb = ' %7.2f'
-            Fc = ' %7.2f\n'
-
-        Fb1 = ''.join([Fb] * (b - 2))
-        Zeil = [Fa + Fb1 + Fc]
-        Fd = '%6.2f'
-        ZeilP = [Fd + Fb1 + Fc]
-
-        for jj in range(a):
-            if jj == 0:
-                fid.write(Zeil[0] % tuple(data[jj, :]))
-            else:
-                fid.write(ZeilP[0] % tuple(data[jj, :]))
+    def process_data(cosmo_dir, operator, regrid_key, files, REF, START, END):
+        # Catalogue of the UV and PS files in the COSMO directory, kept between runs
+        index_dir = os.path.join(cosmo_dir, cosmo_methods.GRIB_INDEX_DIR)
+        catalogue = cosmo_methods.grib_catalogue(cosmo_dir, index_dir)
+
+        # Only the files inside the time window, U, V and PS matched by their times
+        triplets = cosmo_methods.select_grib_files(catalogue, START, END)
+        jobs = [(cosmo_dir, triplet, index_dir, window, operator, regrid_key, START, END)
+                for triplet in triplets]
+
+        if executor == 'process':
+            # Every month is regridded and formatted in its own process into temporary
+            # segments, which are appended to the output files in time order
+            with tempfile.TemporaryDirectory(dir=cosmo_dir) as segment_dir:
+                segment_jobs = [job + (REF, os.path.join(segment_dir, f'{number:05d}'))
+                                for number, job in enumerate(jobs)]
+                segments = cosmo_methods.segments_in_processes(segment_jobs, workers)
+                output_methods.merge_meteo_segments(
+                    files, cosmo_methods.METEO_STREAMS,
+                    tqdm(segments, desc='Extracting wind and pressure fields', total=len(jobs), leave=True, mininterval=0.1))
+            return
+
+        # Readers decode and regrid the next GRIB files (or read them from the cache), this
+        # generator formats the current ones and a writer thread writes the blocks in time order
+        def formatted_blocks():
+            for times, fields in tqdm(cosmo_methods.prefetch(cosmo_methods.regridded_triplet, jobs, workers), desc='Extracting wind and pressure fields', total=len(jobs), leave=True, mininterval=0.1):
+
+                # Format the data once, the wind files share the U and V fields
+                yield output_methods.format_meteo_steps(
+                    cosmo_methods.METEO_STREAMS,
+                    cosmo_methods.meteo_time_lines(times, REF), fields)
+
+        output_methods.write_meteo_blocks(files, formatted_blocks())
 
     # %% Manual inputs
 
@@ -117,10 +78,13 @@ def create_wind_fields_cosmo(grid_ed_path, cosmo_db_utm_path, cosmo_files_path,
     dir_cosmo = cosmo_files_path
 
     REF = dt.datetime.strptime(ref_time, '%Y-%m-%d %H:%M:%S')
-    yr = REF.year
+
+    # Optional time window, without it every GRIB file is used
+    START = dt.datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S') if start_time else None
+    END = dt.datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S') if end_time else None
 
     # Define indexes for COSMO data slicing
-    mm1, mm2, nn1, nn2 = 381, 431, 476, 519
+    window = (381, 431, 476, 519)  # mm1, mm2, nn1, nn2
 
     # %% start code
 
@@ -142,7 +106,12 @@ def create_wind_fields_cosmo(grid_ed_path, cosmo_db_utm_path, cosmo_files_path,
     # Replace zero values in X and Y with NaN
     X[X == 0] = np.nan
     Y[Y == 0] = np.nan
-    a, b = X.shape  # Get the shape of the grid
+
+    # Triangulate the COSMO points once, every field is then a sparse matrix product
+    operator = cosmo_methods.linear_operator(xcos, ycos, X, Y)
+
+    # Regridded fields are cached per grid, they do not depend on the reference time
+    regrid_key = cosmo_methods.grid_key(X, Y, xcos, ycos, window) if cache else None
 
     # Define headers for different data files
     HEADER = {
@@ -227,8 +196,8 @@ def create_wind_fields_cosmo(grid_ed_path, cosmo_db_utm_path, cosmo_files_path,
         for line in HEADER[key]:
             files[key].write(line + '\n')
 
-    # %% Run the data processing for the year
-    process_data(yr, dir_cosmo, X, Y, xcos, ycos, files, REF)
+    # %% Run the data processing
+    process_data(dir_cosmo, operator, regrid_key, files, REF, START, END)
 
     # Close files
     for f in files.values():
@@ -1,3 +1,65 @@
+import os
+from datetime import datetime, timedelta
+
+# Parsed mdf / mdw files, keyed by absolute path and modification time
+_input_file_cache = {}
+
+
+def read_d3d_input_file(path_input):
+    """Read a DELFT3D mdf / mdw file once into an ordered keyword index {keyword: value}.
+    The index is reused until the file is modified."""
+    cache_key = (os.path.abspath(path_input), os.path.getmtime(path_input))
+    if cache_key in _input_file_cache:
+        return _input_file_cache[cache_key]
+
+    keywords = {}
+    with open(path_input, 'r') as input_file:
+        for line in input_file:
+            if '=' in line:
+                keyword, value = line.split('=', 1)
+                # keep the first occurrence, as the line by line search did
+                keywords.setdefault(keyword.strip(), value.strip())
+
+    # Drop older versions of the same file
+    for old_key in [key for key in _input_file_cache if key[0] == cache_key[0]]:
+        del _input_file_cache[old_key]
+    _input_file_cache[cache_key] = keywords
+
+    return keywords
+
+
+def value_from_d3d_input_file(path_input, keyword):
+    """Value of a keyword in a DELFT3D mdf / mdw file.
+    Keywords are matched exactly first, then by the first line containing the keyword."""
+    keywords = read_d3d_input_file(path_input)
+    if keyword in keywords:
+        return keywords[keyword]
+    for line_keyword, value in keywords.items():
+        if keyword in line_keyword or keyword in value:
+            return value
+
+    raise KeyError('{} is not in the file {}'.format(keyword, path_input))
+
+
+def mdf_time_frame(mdf_file):
+    """Simulation time frame from the Tstart, Tstop and Itdate keywords of an mdf file.
+
+    Returns start and stop in minutes since the reference date, the reference date as YYYYMMDD
+    and the start and end time as 'YYYY-MM-DD hh:mm:ss' strings (full hours)."""
+    start = float(value_from_d3d_input_file(mdf_file, 'Tstart'))
+    stop = float(value_from_d3d_input_file(mdf_file, 'Tstop'))
+    ref_time = value_from_d3d_input_file(mdf_file, 'Itdate')[1:11]
+    # remove the hyphen for the bct file format
+    reference_time = ref_time.replace('-', '')
+
+    date_format_str = "%Y-%m-%d %H:%M:%S"
+    extracted_time = datetime.strptime(ref_time + " 00:00:00", date_format_str)  # Assuming it always starts at 00
+    start_time = extracted_time + timedelta(hours=int(start/60))
+    end_time = extracted_time + timedelta(hours=int(stop/60))
+
+    return start, stop, reference_time, start_time.strftime(date_format_str), end_time.strftime(date_format_str)
+
+
 def extract_bnd_grd_indices(path_bnd):
     """Read DELFT3D bnd file to extract m / n indices for boundary start / end points."""
     bnd_data = []
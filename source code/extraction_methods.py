@@ -0,0 +1,657 @@
+# -*- coding: utf-8 -*-
+"""
+Shared extraction methods for the EasyGSH boundary condition generators
+The interpolation stencil (corner indices and weights) is computed for all
+boundary points at once and only the grid cells of its corners are read.
+Both the regridded lat / lon product and the native UnTRIM mesh faces are supported
+"""
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+try:
+    import utm
+except ModuleNotFoundError as err:
+    # Error handling
+    print(
+        str(err) + ' Module utm doesnt exist please install it in your environment,',
+        'conda code: conda install - c conda-forge utm',
+        'pip code: pip install utm')
+
+try:
+    import xarray as xr
+except ModuleNotFoundError as err_4:
+    # Error handling
+    print(
+        str(err_4) +
+        ' This package also requires extra dependencies like netCDF4, h5netcdf and possibly scipy')
+
+try:
+    from scipy.spatial import cKDTree
+except ModuleNotFoundError as err:
+    # Error handling
+    print(str(err) + ' Module scipy is needed to extract from the native UnTRIM mesh')
+
+
+EASYGSH_TIME_STEP = 20  # minutes between two EasyGSH records
+MESH_FACE_DIM = 'nMesh2_face'
+MESH_FACE_LAT = 'Mesh2_face_lat'
+MESH_FACE_LON = 'Mesh2_face_lon'
+CELL_READ_SKIP = 8  # unwanted cells a read may step over before a new read is started
+BLOCK_VALUES = 2000000  # corner values of one block of records read and gap filled at a time
+
+WATER_LEVEL = 'Mesh2_face_Wasserstand_2d'
+WAVE_VARIABLES = ['Mesh2_face_Wellenrichtungsvektor_x_2d', 'Mesh2_face_Wellenrichtungsvektor_y_2d',
+                  'Mesh2_face_signifikante_Wellenhoehe_2d', 'Mesh2_face_Peak_Wellenperiode_2d',
+                  'Mesh2_face_Richtungsaufweitung_der_Wellen_2d']
+
+# Boundary ends and variables every output format is written from
+OUTPUT_REQUIREMENTS = {'bct': {'ends': ('a', 'b'), 'variables': [WATER_LEVEL]},
+                       'bcw': {'ends': ('a',), 'variables': WAVE_VARIABLES}}
+
+
+def time_stride(step, data_step=EASYGSH_TIME_STEP):
+    """Number of EasyGSH records per requested time step (at least one)."""
+    stride = max(int(round(float(step) / data_step)), 1)
+    if stride * data_step != float(step):
+        print('Time step {} min is not a multiple of {} min, every {} min is extracted'.format(
+            step, data_step, stride * data_step))
+    return stride
+
+
+def plan_extraction(boundary_names, output_format):
+    """Boundary points and variables an output format actually needs.
+    bct files are written from both ends (_a, _b) of every boundary, bcw files only from the
+    start points (_a). Returns the positions of the needed points and the variable names."""
+    requirements = OUTPUT_REQUIREMENTS[output_format]
+    points = [idx for idx, name in enumerate(boundary_names)
+              if str(name).split('_')[-1] in requirements['ends']]
+
+    return {'points': np.array(points, dtype=int), 'variables': list(requirements['variables'])}
+
+
+def boundary_locations(boundaries, output_format=None):
+    """Read a boundary csv file (name, easting, northing in UTM zone 32N) and convert the
+    points to geographic coordinates. With an output format only the points it needs are kept.
+    Returns a DataFrame with the columns lat, lon and boundaries."""
+    bnd_loc = pd.read_csv(boundaries, names=['boundary', 'easting', 'northing'], )
+
+    easting = bnd_loc['easting'].to_numpy(dtype='float64')
+    northing = bnd_loc['northing'].to_numpy(dtype='float64')
+    lat, lon = utm.to_latlon(easting, northing, 32, 'N')
+    bnd_loc_geo = pd.DataFrame({'lat': lat, 'lon': lon, 'boundaries': bnd_loc['boundary']})
+
+    if output_format is not None:
+        plan = plan_extraction(bnd_loc_geo['boundaries'], output_format)
+        bnd_loc_geo = bnd_loc_geo.iloc[plan['points']].reset_index(drop=True)
+
+    return bnd_loc_geo
+
+
+def needs_resampling(step, data_step=EASYGSH_TIME_STEP):
+    """True if the requested time step is not a whole multiple of the EasyGSH interval."""
+    return float(step) % data_step != 0
+
+
+def resample_times(times, step):
+    """Times every step minutes from the first record up to the last record."""
+    times = np.asarray(times, dtype='float64')
+    return times[0] + step * np.arange(int(np.floor((times[-1] - times[0]) / step + 1e-9)) + 1)
+
+
+def resample_linear(values, times, new_times):
+    """Linear interpolation in time of an array shaped (time, ...) to new times, all columns at once."""
+    values = np.asarray(values, dtype='float64')
+    times = np.asarray(times, dtype='float64')
+    new_times = np.asarray(new_times, dtype='float64')
+    if len(times) == 1:
+        return np.repeat(values, len(new_times), axis=0)
+
+    idx = np.clip(np.searchsorted(times, new_times, side='right') - 1, 0, len(times) - 2)
+    fraction = (new_times - times[idx]) / (times[idx + 1] - times[idx])
+    fraction = fraction.reshape((-1,) + (1,) * (values.ndim - 1))
+
+    return values[idx] + fraction * (values[idx + 1] - values[idx])
+
+
+def resample_direction(directions, times, new_times):
+    """Circular interpolation in time of directions in degrees, through their unit vectors,
+    so e.g. 350 and 10 degrees are interpolated across north."""
+    rad = np.radians(directions)
+    sin = resample_linear(np.sin(rad), times, new_times)
+    cos = resample_linear(np.cos(rad), times, new_times)
+
+    return np.degrees(np.arctan2(sin, cos)) % 360
+
+
+def select_time_window(data, start_time, end_time, stride, time_dim='nMesh2_data_time'):
+    """Select the time window with the stride passed on to the netcdf reader,
+    so only the requested records are decoded."""
+    return data.sel({time_dim: slice(start_time, end_time, stride)})
+
+
+def minutes_since(times, origin):
+    """Minutes between the selected time records and an origin timestamp."""
+    times = np.asarray(times, dtype='datetime64[ns]')
+    return (times - np.datetime64(origin, 'ns')) / np.timedelta64(1, 'm')
+
+
+def open_time_window(nc_files, start_time, end_time, stride, time_dim='nMesh2_data_time'):
+    """Open one EasyGSH file, or an ordered list of yearly files, and select the time window.
+
+    Every file is opened lazily on its own and keeps its own selection of records, so
+    the stencil is later applied file by file. Records repeated at the junction of two files
+    are kept only once and the stride runs on across the junction.
+    Returns the list of windowed Datasets, one per file with records in the window."""
+    if isinstance(nc_files, str):
+        nc_files = [nc_files]
+    datasets = [xr.open_dataset(nc_file) for nc_file in nc_files]
+    if len(datasets) == 1:
+        return [select_time_window(datasets[0], start_time, end_time, stride, time_dim)]
+
+    # only the time coordinates are read to decide which records of which file are kept
+    times = [ds[time_dim].values for ds in datasets]
+    file_number = np.concatenate([np.full(len(t), number) for number, t in enumerate(times)])
+    record = np.concatenate([np.arange(len(t)) for t in times])
+    all_times = np.concatenate(times)
+
+    _, unique_idx = np.unique(all_times, return_index=True)
+    n_duplicates = len(all_times) - len(unique_idx)
+    if n_duplicates > 0:
+        print('{} duplicated time records removed between the files'.format(n_duplicates))
+    in_window = ((all_times[unique_idx] >= pd.Timestamp(start_time).to_datetime64()) &
+                 (all_times[unique_idx] <= pd.Timestamp(end_time).to_datetime64()))
+    keep = unique_idx[in_window][::stride]
+
+    windows = []
+    for number, ds in enumerate(datasets):
+        records = record[keep[file_number[keep] == number]]
+        if len(records) == 0:
+            continue
+        step = records[1] - records[0] if len(records) > 1 else 1
+        if np.all(np.diff(records) == step):
+            records = slice(int(records[0]), int(records[-1]) + 1, int(step))
+        windows.append(ds.isel({time_dim: records}))
+
+    return windows
+
+
+def window_times(windows, time_dim='nMesh2_data_time'):
+    """Time records of a list of windowed Datasets as one array."""
+    return np.concatenate([ds[time_dim].values for ds in windows])
+
+
+def bilinear_stencil(lat_vals, lon_vals, lat, lon):
+    """Compute corner indices and bilinear weights for all points at once.
+
+    Returns a dict with the grid indexers and the weights, both shaped (point, corner).
+    The corners are ordered Q11, Q21, Q12, Q22 as in the single point interpolation."""
+    lat_vals = np.asarray(lat_vals)
+    lon_vals = np.asarray(lon_vals)
+    lat = np.asarray(lat, dtype='float64')
+    lon = np.asarray(lon, dtype='float64')
+
+    lat_idx1 = np.searchsorted(lat_vals, lat) - 1
+    lat_idx2 = lat_idx1 + 1
+    lon_idx1 = np.searchsorted(lon_vals, lon) - 1
+    lon_idx2 = lon_idx1 + 1
+
+    lat_idx1 = np.clip(lat_idx1, 0, len(lat_vals) - 1)
+    lat_idx2 = np.clip(lat_idx2, 0, len(lat_vals) - 1)
+    lon_idx1 = np.clip(lon_idx1, 0, len(lon_vals) - 1)
+    lon_idx2 = np.clip(lon_idx2, 0, len(lon_vals) - 1)
+
+    lat1, lat2 = lat_vals[lat_idx1], lat_vals[lat_idx2]
+    lon1, lon2 = lon_vals[lon_idx1], lon_vals[lon_idx2]
+
+    weights = np.stack([(lat2 - lat) * (lon2 - lon),
+                        (lat - lat1) * (lon2 - lon),
+                        (lat2 - lat) * (lon - lon1),
+                        (lat - lat1) * (lon - lon1)], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = weights / weights.sum(axis=1, keepdims=True)
+
+    indexers = {'lat': np.stack([lat_idx1, lat_idx2, lat_idx1, lat_idx2], axis=1),
+                'lon': np.stack([lon_idx1, lon_idx1, lon_idx2, lon_idx2], axis=1)}
+
+    return {'indexers': indexers, 'weights': weights}
+
+
+def stencil_cache_path(boundaries):
+    """Name of the stencil cache stored next to the boundary csv file."""
+    return '{}_stencil.npz'.format(os.path.splitext(boundaries)[0])
+
+
+def stencil_cache_key(axes, lat, lon):
+    """Hash of the source grid axes and the boundary coordinates."""
+    digest = hashlib.sha1()
+    for arr in list(axes) + [lat, lon]:
+        digest.update(np.ascontiguousarray(arr, dtype='float64').tobytes())
+    return digest.hexdigest()
+
+
+def save_stencil(cache_file, stencil, key):
+    """Store the stencil and its key in a small npz file."""
+    arrays = {'indexer_{}'.format(dim): idx for dim, idx in stencil['indexers'].items()}
+    try:
+        np.savez(cache_file, key=np.array(key), weights=stencil['weights'], **arrays)
+    except OSError as err:
+        print('Interpolation weights could not be cached: {}'.format(err))
+
+
+def load_stencil(cache_file, key):
+    """Load a cached stencil, returns None if missing or computed for another grid / boundary set."""
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cached:
+            if str(cached['key']) != key:
+                return None
+            indexers = {name[len('indexer_'):]: cached[name]
+                        for name in cached.files if name.startswith('indexer_')}
+            return {'indexers': indexers, 'weights': cached['weights']}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def mesh_tree(face_lat, face_lon):
+    """KD-tree over the face centres of the UnTRIM mesh.
+
+    Longitudes are scaled by the cosine of the mean latitude so distances are roughly isotropic."""
+    face_lat = np.asarray(face_lat, dtype='float64')
+    face_lon = np.asarray(face_lon, dtype='float64')
+    lon_scale = np.cos(np.radians(np.nanmean(face_lat)))
+    tree = cKDTree(np.column_stack([face_lon * lon_scale, face_lat]))
+
+    return tree, lon_scale
+
+
+def mesh_stencil(face_lat, face_lon, lat, lon, n_faces=4, power=2):
+    """Inverse distance stencil on the faces of the UnTRIM mesh for all points at once.
+
+    The n_faces nearest face centres of every point are found in one batched tree query.
+    Returns the generic stencil dict with a single face indexer shaped (point, corner)."""
+    lat = np.asarray(lat, dtype='float64')
+    lon = np.asarray(lon, dtype='float64')
+    tree, lon_scale = mesh_tree(face_lat, face_lon)
+
+    distance, face_idx = tree.query(np.column_stack([lon * lon_scale, lat]), k=n_faces)
+    distance = distance.reshape(len(lat), n_faces)
+    face_idx = face_idx.reshape(len(lat), n_faces)
+
+    # a point on a face centre takes that face only
+    exact = distance == 0
+    with np.errstate(divide='ignore'):
+        weights = np.where(exact.any(axis=1, keepdims=True), exact, 1 / distance ** power)
+    weights = weights / weights.sum(axis=1, keepdims=True)
+
+    return {'indexers': {MESH_FACE_DIM: face_idx}, 'weights': weights}
+
+
+def is_mesh_dataset(ds):
+    """True for native UnTRIM files with face centre coordinates instead of lat / lon axes."""
+    return MESH_FACE_LAT in ds.variables and MESH_FACE_LON in ds.variables
+
+
+def grid_axes(ds):
+    """Coordinates the stencil of a dataset is computed from: the face centres of native
+    UnTRIM files or the regular lat / lon axes."""
+    if is_mesh_dataset(ds):
+        return [ds[MESH_FACE_LAT].values, ds[MESH_FACE_LON].values]
+    return [ds.coords['lat'].values, ds.coords['lon'].values]
+
+
+def grid_stencil(ds, lat, lon, cache_file=None):
+    """Interpolation stencil for an EasyGSH dataset.
+
+    Regular lat / lon axes use the bilinear stencil, native UnTRIM files an inverse distance
+    stencil on the mesh faces. If a cache file is given the stencil is reused as long as grid
+    and boundaries are unchanged."""
+    axes = grid_axes(ds)
+    if is_mesh_dataset(ds):
+        def compute():
+            return mesh_stencil(axes[0], axes[1], lat, lon)
+    else:
+        def compute():
+            return bilinear_stencil(axes[0], axes[1], lat, lon)
+
+    if cache_file is None:
+        return compute()
+
+    key = stencil_cache_key(axes, lat, lon)
+    stencil = load_stencil(cache_file, key)
+    if stencil is None:
+        stencil = compute()
+        save_stencil(cache_file, stencil, key)
+    else:
+        print('Interpolation weights reused from {}'.format(cache_file))
+
+    return stencil
+
+
+def take_stencil(stencil, idx):
+    """Stencil of a subset of the points."""
+    return {'indexers': {dim: ix[idx] for dim, ix in stencil['indexers'].items()},
+            'weights': stencil['weights'][idx]}
+
+
+def shared_stencils(datasets, locations, cache_file=None):
+    """Stencils for several boundary sets, computed once for all distinct points.
+
+    Points that appear in more than one set (or twice in one set) are interpolated once.
+    Datasets on the same grid share one stencil, so flow and wave boundaries on the EasyGSH
+    grid cost a single weight computation. Returns one stencil per (dataset, locations) pair."""
+    points = np.concatenate([np.column_stack([loc['lat'], loc['lon']]) for loc in locations])
+    unique_points, inverse = np.unique(points, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    print('{} boundary points, {} distinct locations'.format(len(points), len(unique_points)))
+
+    grid_keys = [stencil_cache_key(grid_axes(ds), [], []) for ds in datasets]
+    n_grids = len(set(grid_keys))
+    shared = {}
+    stencils = []
+    first = 0
+    for ds, grid_key, loc in zip(datasets, grid_keys, locations):
+        if grid_key not in shared:
+            grid_cache = cache_file
+            if cache_file is not None and n_grids > 1:
+                # one cache file per grid
+                root, ext = os.path.splitext(cache_file)
+                grid_cache = '{}_{}{}'.format(root, len(shared) + 1, ext)
+            shared[grid_key] = grid_stencil(ds, unique_points[:, 0], unique_points[:, 1],
+                                            cache_file=grid_cache)
+        stencils.append(take_stencil(shared[grid_key], inverse[first:first + len(loc)]))
+        first += len(loc)
+
+    return stencils
+
+
+def report_filled_gaps(boundary_names, filled_gaps, variable):
+    """Print the number of filled gaps for every boundary point that had any."""
+    for bnd_name, n_gaps in zip(boundary_names, filled_gaps):
+        if n_gaps > 0:
+            print('{} gaps filled at {} in {}'.format(n_gaps, bnd_name, variable))
+
+
+def report_missing_data(boundary_names, values, variable):
+    """Print every boundary point with records where none of its corners had data."""
+    missing = np.isnan(values).sum(axis=0)
+    for bnd_name, n_missing in zip(boundary_names, missing):
+        if n_missing > 0:
+            print('WARNING: no data at {} in {} for {} of {} records'.format(
+                bnd_name, variable, n_missing, len(values)))
+
+
+def nautical_direction(x, y):
+    """Nautical wave direction (coming from, clockwise from north, in degrees [0, 360))
+    for arrays of x (eastward) and y (northward) direction vector components.
+    Axis aligned vectors are handled like any other, so the series keep their length."""
+    return (np.degrees(np.arctan2(x, y)) + 180) % 360
+
+
+def stencil_cells(stencil):
+    """Distinct grid cells of a stencil shaped (cell, dim), sorted, with the cell number of
+    every (point, corner). Neighbouring points share corners, so each cell is read only once."""
+    dims = list(stencil['indexers'])
+    corners = np.stack([np.asarray(stencil['indexers'][dim]).ravel() for dim in dims], axis=1)
+    cells, inverse = np.unique(corners, axis=0, return_inverse=True)
+
+    return dims, cells, inverse.reshape(stencil['weights'].shape)
+
+
+def cell_reads(dims, cells, max_skip=CELL_READ_SKIP):
+    """Plan the reads of the sorted cells returned by stencil_cells.
+
+    Cells are grouped by their leading grid indices (one lat row of the regular grid, the
+    whole face list of the mesh) and every group is read as slices of the last dimension,
+    a new slice being started where more than max_skip unwanted cells lie in between.
+    Returns a list of (indexers, cell numbers, offsets of the cells in the slice)."""
+    rows = cells[:, :-1]
+    last = cells[:, -1]
+    breaks = np.flatnonzero(np.any(np.diff(rows, axis=0) != 0, axis=1) |
+                            (np.diff(last) > max_skip + 1)) + 1
+
+    reads = []
+    for numbers in np.split(np.arange(len(cells)), breaks):
+        first = last[numbers[0]]
+        indexers = {dim: int(index) for dim, index in zip(dims[:-1], rows[numbers[0]])}
+        indexers[dims[-1]] = slice(int(first), int(last[numbers[-1]]) + 1)
+        reads.append((indexers, numbers, last[numbers] - first))
+
+    return reads
+
+
+def read_cells(ds, variables, reads, n_cells, time_slice=slice(None)):
+    """Read the planned cells of several variables for a slice of records.
+    Only the rows and slices of the plan are decoded by the netcdf reader.
+    Returns an array shaped (variable, time, cell)."""
+    time_dim = ds[variables[0]].dims[0]
+    subset = ds[list(variables)].isel({time_dim: time_slice})
+    values = np.empty((len(variables), subset.sizes[time_dim], n_cells), dtype='float64')
+    for indexers, numbers, offsets in reads:
+        block = subset.isel(indexers).to_array('variable').transpose('variable', time_dim, ...)
+        values[:, :, numbers] = block.values[:, :, offsets]
+
+    return values
+
+
+def gap_state(n_columns):
+    """Gap filling state carried from block to block: for every column the index and value of
+    the last valid record (-1 and NaN before the first one) and the first record of a gap
+    still open at the end of the previous block (-1 if none)."""
+    return {'last_index': np.full(n_columns, -1), 'last_value': np.full(n_columns, np.nan),
+            'gap_start': np.full(n_columns, -1)}
+
+
+def fill_block(block, first, state, max_gap=None):
+    """Fill the NaN runs of a (time, column) block holding the records first, first + 1, ...
+
+    Interior runs are interpolated linearly in time, leading runs take the next valid value and
+    trailing runs the last one (see close_gaps). Runs longer than max_gap records are left as
+    NaN. Zeros are real data. Runs reaching the end of the block stay NaN and are carried over
+    in state until a later block closes them.
+    Returns the filled block, the number of filled runs per column and the carried runs closed
+    by this block as a list of (column, record indices, filled values)."""
+    filled = np.array(block, dtype='float64')
+    n_time, n_column = filled.shape
+    end = first + n_time
+    gap = np.isnan(filled)
+    time_idx = first + np.arange(n_time)[:, None]
+    columns = np.arange(n_column)[None, :]
+
+    # index of the last valid record before, possibly in an earlier block,
+    # and of the first valid record after every record of the block
+    prev_idx = np.maximum.accumulate(np.where(gap, -1, time_idx), axis=0)
+    in_block = prev_idx >= first
+    prev_idx = np.where(in_block, prev_idx, state['last_index'])
+    next_idx = np.minimum.accumulate(np.where(gap, end, time_idx)[::-1], axis=0)[::-1]
+    has_prev = prev_idx >= 0
+    has_next = next_idx < end
+
+    prev_val = np.where(in_block, filled[np.clip(prev_idx - first, 0, n_time - 1), columns],
+                        state['last_value'])
+    next_val = filled[np.clip(next_idx - first, 0, n_time - 1), columns]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = (time_idx - prev_idx) / (next_idx - prev_idx)
+    interp = np.where(has_prev, prev_val + fraction * (next_val - prev_val), next_val)
+
+    fillable = gap & has_next
+    if max_gap is not None:
+        fillable &= (next_idx - prev_idx - 1) <= max_gap
+
+    # records of carried runs that the first valid record of this block closes
+    n_filled = np.zeros(n_column, dtype='int64')
+    closed = []
+    carried = state['gap_start'] >= 0
+    for column in np.flatnonzero(carried & has_next[0]):
+        last_index = state['last_index'][column]
+        next_index = next_idx[0, column]
+        if max_gap is not None and next_index - last_index - 1 > max_gap:
+            continue
+        records = np.arange(state['gap_start'][column], first)
+        if last_index >= 0:
+            last_value = state['last_value'][column]
+            fraction = (records - last_index) / (next_index - last_index)
+            values = last_value + fraction * (next_val[0, column] - last_value)
+        else:
+            values = np.full(len(records), next_val[0, column])
+        closed.append((column, records, values))
+        n_filled[column] += 1
+
+    filled[fillable] = interp[fillable]
+    run_start = fillable.copy()
+    run_start[0] &= ~carried
+    run_start[1:] &= ~fillable[:-1]
+    n_filled += run_start.sum(axis=0)
+
+    state['gap_start'] = np.where(gap[-1], prev_idx[-1] + 1, -1)
+    state['last_index'] = prev_idx[-1]
+    state['last_value'] = prev_val[-1]
+
+    return filled, n_filled, closed
+
+
+def close_gaps(state, n_time, max_gap=None):
+    """Close the runs still open after the last block, they take the last valid value.
+    Returns the number of filled runs per column and the closed runs as in fill_block."""
+    n_filled = np.zeros(len(state['gap_start']), dtype='int64')
+    closed = []
+    for column in np.flatnonzero((state['gap_start'] >= 0) & (state['last_index'] >= 0)):
+        if max_gap is not None and n_time - state['last_index'][column] - 1 > max_gap:
+            continue
+        records = np.arange(state['gap_start'][column], n_time)
+        closed.append((column, records, np.full(len(records), state['last_value'][column])))
+        n_filled[column] += 1
+
+    return n_filled, closed
+
+
+def interpolate_cube(ds, variables, stencil, time_chunk=None, max_gap=None):
+    """Interpolate several variables to all stencil points, one block of records at a time.
+
+    ds is a Dataset or a list of windowed Datasets (see open_time_window) read one after the
+    other as a single time series, so gaps at the junction of two files are filled as well.
+    Every block is read, gap filled and weighted before the next one, so only the results
+    shaped (variable, time, point) are held at full length. The block length is time_chunk
+    records, by default as many as keep a block below BLOCK_VALUES values.
+    Corners without data, e.g. dry or land cells or gaps longer than max_gap, are left out
+    and the weights of the remaining corners of that point and record are renormalised.
+    Records where no corner has data stay NaN.
+    Returns the values shaped (variable, time, point) and the number of filled gaps shaped
+    (variable, point)."""
+    variables = list(variables)
+    windows = ds if isinstance(ds, list) else [ds]
+    weights = stencil['weights']
+    n_point, n_corner = weights.shape
+    dims, cells, inverse = stencil_cells(stencil)
+    reads = cell_reads(dims, cells)
+    n_variable, n_cell = len(variables), len(cells)
+    lengths = [window.sizes[window[variables[0]].dims[0]] for window in windows]
+    n_time = sum(lengths)
+    if time_chunk is None:
+        time_chunk = max(BLOCK_VALUES // (n_variable * n_point * n_corner), 1)
+
+    # weighted sum, summed weight and number of the corners with data
+    sums = np.zeros((n_variable, n_time, n_point))
+    weight = np.zeros((n_variable, n_time, n_point))
+    count = np.zeros((n_variable, n_time, n_point), dtype='int16')
+
+    def add_block(first, filled):
+        corners = filled.reshape(len(filled), n_variable, n_cell)[:, :, inverse]
+        valid = ~np.isnan(corners)
+        last = first + len(filled)
+        sums[:, first:last] = np.einsum(
+            '...pc,pc->...p', np.where(valid, corners, 0), weights).transpose(1, 0, 2)
+        weight[:, first:last] = np.einsum(
+            '...pc,pc->...p', valid.astype('float64'), weights).transpose(1, 0, 2)
+        count[:, first:last] = valid.sum(axis=-1).transpose(1, 0, 2)
+
+    def add_closed(closed):
+        for column, records, values in closed:
+            variable, cell = divmod(column, n_cell)
+            for point, corner in zip(*np.nonzero(inverse == cell)):
+                sums[variable, records, point] += weights[point, corner] * values
+                weight[variable, records, point] += weights[point, corner]
+                count[variable, records, point] += 1
+
+    # all corner cells of all variables are gap filled together, (time, variable * cell)
+    state = gap_state(n_variable * n_cell)
+    filled_runs = np.zeros(n_variable * n_cell, dtype='int64')
+    offset = 0
+    for window, length in zip(windows, lengths):
+        for start in range(0, length, time_chunk):
+            stop = min(start + time_chunk, length)
+            block = read_cells(window, variables, reads, n_cell, slice(start, stop))
+            filled, n_filled, closed = fill_block(
+                block.transpose(1, 0, 2).reshape(stop - start, -1), offset + start, state,
+                max_gap=max_gap)
+            add_block(offset + start, filled)
+            add_closed(closed)
+            filled_runs += n_filled
+        offset += length
+    n_filled, closed = close_gaps(state, n_time, max_gap=max_gap)
+    add_closed(closed)
+    filled_runs += n_filled
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = np.where(count == n_corner, sums,
+                          np.where(weight > 0, sums / weight, np.nan))
+    filled_gaps = filled_runs.reshape(n_variable, n_cell)[:, inverse].sum(axis=2)
+
+    return values, filled_gaps
+
+
+def split_stencil(stencil, n_blocks):
+    """Split a stencil into consecutive blocks of points."""
+    n_point = stencil['weights'].shape[0]
+    n_blocks = max(min(n_blocks, n_point), 1)
+
+    return [take_stencil(stencil, idx) for idx in np.array_split(np.arange(n_point), n_blocks)]
+
+
+def _interpolate_job(job):
+    """Process pool worker: reopen the source files and interpolate one block of points."""
+    nc_files, start_time, end_time, stride, variables, stencil, time_chunk, max_gap = job
+    windows = open_time_window(nc_files, start_time, end_time, stride)
+
+    return interpolate_cube(windows, variables, stencil, time_chunk=time_chunk, max_gap=max_gap)
+
+
+def interpolate_variables(ds, variables, stencil, workers=None, executor='thread', source=None,
+                          time_chunk=None, max_gap=None):
+    """Interpolate several variables to all stencil points, all variables in a single read.
+    ds is a Dataset or the list of windowed Datasets of open_time_window.
+
+    With workers > 1 blocks of points are spread over a thread pool.
+    executor='process' uses a process pool instead, where every worker reopens the files
+    described by source = (nc_files, start_time, end_time, stride).
+    Returns a dict {variable: (values shaped (time, point), filled gaps per point)}
+    in the order of the requested variables, whatever order the workers finish in."""
+    variables = list(variables)
+    if workers is None or workers <= 1:
+        results = [interpolate_cube(ds, variables, stencil, time_chunk=time_chunk, max_gap=max_gap)]
+    else:
+        blocks = split_stencil(stencil, workers)
+        if executor == 'process':
+            if source is None:
+                raise ValueError('The process pool needs the source files to reopen them in the workers')
+            nc_files, start_time, end_time, stride = source
+            process_jobs = [(nc_files, start_time, end_time, stride, variables, block, time_chunk, max_gap)
+                            for block in blocks]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_interpolate_job, process_jobs))
+        else:
+            def thread_job(block):
+                return interpolate_cube(ds, variables, block, time_chunk=time_chunk, max_gap=max_gap)
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(thread_job, blocks))
+
+    # pool.map keeps the job order, so the blocks are reassembled in point order
+    values = np.concatenate([values for values, _ in results], axis=2)
+    filled_gaps = np.concatenate([filled for _, filled in results], axis=1)
+
+    return {variable: (values[number], filled_gaps[number])
+            for number, variable in enumerate(variables)}
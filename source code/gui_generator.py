@@ -5,11 +5,13 @@ from PIL import Image, ImageTk
 import sys
 import time
 import threading
+import multiprocessing
 import queue
 import numpy as np
 import output_methods
 import extract_from_d3d_files
 import bct_generator
+import bct_bcw_generator
 import bct_year_overlap_file_generator
 import bcw_generator
 import bcw_year_overlap_file_generator
@@ -18,9 +20,9 @@ import sea_level_change
 import rep_period
 import plot_windroses
 import cosmo_wind_file_generator
+import cosmo_methods
 import ast
 import os
-from datetime import datetime, timedelta
 
 
 def show_splash(app, resource_path):
@@ -431,17 +433,6 @@ class Application(tk.Tk):
                 step = step_number(step_f)
                 step_wave = step_number_w(step_w)
 
-                def value_from_txt_file(file, string_name):
-                    file1 = open(file, "r")
-                    for line in file1:
-                        if '=' in line:
-                            if string_name in line:
-                                val = line.split('=')
-                                string_val = val[1].strip()
-                                break
-                    file1.close()
-                    return string_val
-
                 # Files
                 mdf_file = mdf_entry.get()
                 mdw_file = mdw_entry.get()
@@ -453,29 +444,8 @@ class Application(tk.Tk):
                 nc_file_wave = ncw_entry.get()
 
                 # Extract start and end time from mdf file
-                string1 = 'Tstart'
-                tstart_val = value_from_txt_file(
-                    file=mdf_file, string_name=string1)
-                string2 = 'Tstop'
-                tstop_val = value_from_txt_file(
-                    file=mdf_file, string_name=string2)
-                string3 = 'Itdate'  # reference time
-                ref_time_unedited = value_from_txt_file(
-                    file=mdf_file, string_name=string3)
-                start = float(tstart_val)  # from mdf file
-                stop = float(tstop_val)  # from mdf file
-                ref_time = ref_time_unedited[1:11]
-                # remove the hyphen for the bct file format
-                reference_time = ref_time.replace('-', '')
-                time_start = ref_time+" 00:00:00"  # Assuming it always starts at 00
-                date_format_str = "%Y-%m-%d %H:%M:%S"
-                start_time_steps = int(start/60)  # to convert minutes to hours
-                end_time_steps = int(stop/60)
-                extracted_time = datetime.strptime(time_start, date_format_str)
-                start_time = extracted_time + timedelta(hours=start_time_steps)
-                start_time = start_time .strftime("%Y-%m-%d %H:%M:%S")
-                end_time = extracted_time + timedelta(hours=end_time_steps)
-                end_time = end_time .strftime("%Y-%m-%d %H:%M:%S")
+                start, stop, reference_time, start_time, end_time = \
+                    extract_from_d3d_files.mdf_time_frame(mdf_file)
 
                 # Output files
                 name_with_dot = mdf_file.partition('.')
@@ -503,17 +473,13 @@ class Application(tk.Tk):
                 output_methods.write_bnd_coord_ascii(
                     bnd_data_list=coord_from_d3d_wave_grd_output, out_path=wave_path_out_file)
 
-                # Create the bct file
+                # Create the bct and bcw files in one joint run
                 boundaries = path_out_file  # the csv file generated from process one
-                bct = bct_generator.bct_file_generator(
-                    boundaries=boundaries, nc_file=nc_file, mdf_file=mdf_file, step=step,
-                    bct_file_name=bct_file_name)
-
-                # Create the bcw file
                 boundaries_wave = wave_path_out_file
-                bcw = bcw_generator.bcw_file_generator(
-                    boundaries_wave=boundaries_wave, nc_file_wave=nc_file_wave, mdw_file=mdw_file, start_time=start_time,
-                    end_time=end_time, step_wave=step_wave, bcw_file_name=bcw_file)
+                bct_bcw_generator.bct_bcw_file_generator(
+                    boundaries=boundaries, boundaries_wave=boundaries_wave, nc_file=nc_file,
+                    nc_file_wave=nc_file_wave, mdf_file=mdf_file, mdw_file=mdw_file, step=step,
+                    step_wave=step_wave, bct_file_name=bct_file_name, bcw_file_name=bcw_file)
 
                 # Write the new mdw file
                 mdw_writer.write_mdw_file(
@@ -624,17 +590,6 @@ class Application(tk.Tk):
 
                 step = step_number(step_f)
 
-                def value_from_txt_file(file, string_name):
-                    file1 = open(file, "r")
-                    for line in file1:
-                        if '=' in line:
-                            if string_name in line:
-                                val = line.split('=')
-                                string_val = val[1].strip()
-                                break
-                    file1.close()
-                    return string_val
-
                 # Files
                 mdf_file = mdf_entry.get()
                 grid_input = grd_entry.get()
@@ -642,29 +597,8 @@ class Application(tk.Tk):
                 nc_file = nc_entry.get()
 
                 # Extract start and end time from mdf file
-                string1 = 'Tstart'
-                tstart_val = value_from_txt_file(
-                    file=mdf_file, string_name=string1)
-                string2 = 'Tstop'
-                tstop_val = value_from_txt_file(
-                    file=mdf_file, string_name=string2)
-                string3 = 'Itdate'  # reference time
-                ref_time_unedited = value_from_txt_file(
-                    file=mdf_file, string_name=string3)
-                start = float(tstart_val)  # from mdf file
-                stop = float(tstop_val)  # from mdf file
-                ref_time = ref_time_unedited[1:11]
-                # remove the hyphen for the bct file format
-                reference_time = ref_time.replace('-', '')
-                time_start = ref_time+" 00:00:00"  # Assuming it always starts at 00
-                date_format_str = "%Y-%m-%d %H:%M:%S"
-                start_time_steps = int(start/60)  # to convert minutes to hours
-                end_time_steps = int(stop/60)
-                extracted_time = datetime.strptime(time_start, date_format_str)
-                start_time = extracted_time + timedelta(hours=start_time_steps)
-                start_time = start_time .strftime("%Y-%m-%d %H:%M:%S")
-                end_time = extracted_time + timedelta(hours=end_time_steps)
-                end_time = end_time .strftime("%Y-%m-%d %H:%M:%S")
+                start, stop, reference_time, start_time, end_time = \
+                    extract_from_d3d_files.mdf_time_frame(mdf_file)
 
                 # Output files
                 name_with_dot = mdf_file.partition('.')
@@ -794,17 +728,6 @@ class Application(tk.Tk):
 
                 step = step_number(step_f)
 
-                def value_from_txt_file(file, string_name):
-                    file1 = open(file, "r")
-                    for line in file1:
-                        if '=' in line:
-                            if string_name in line:
-                                val = line.split('=')
-                                string_val = val[1].strip()
-                                break
-                    file1.close()
-                    return string_val
-
                 # Files
                 mdf_file = mdf_entry.get()
                 grid_input = grd_entry.get()
@@ -813,29 +736,8 @@ class Application(tk.Tk):
                 nc_file_2 = nc_entry_2.get()
 
                 # Extract start and end time from mdf file
-                string1 = 'Tstart'
-                tstart_val = value_from_txt_file(
-                    file=mdf_file, string_name=string1)
-                string2 = 'Tstop'
-                tstop_val = value_from_txt_file(
-                    file=mdf_file, string_name=string2)
-                string3 = 'Itdate'  # reference time
-                ref_time_unedited = value_from_txt_file(
-                    file=mdf_file, string_name=string3)
-                start = float(tstart_val)  # from mdf file
-                stop = float(tstop_val)  # from mdf file
-                ref_time = ref_time_unedited[1:11]
-                # remove the hyphen for the bct file format
-                reference_time = ref_time.replace('-', '')
-                time_start = ref_time+" 00:00:00"  # Assuming it always starts at 00
-                date_format_str = "%Y-%m-%d %H:%M:%S"
-                start_time_steps = int(start/60)  # to convert minutes to hours
-                end_time_steps = int(stop/60)
-                extracted_time = datetime.strptime(time_start, date_format_str)
-                start_time = extracted_time + timedelta(hours=start_time_steps)
-                start_time = start_time .strftime("%Y-%m-%d %H:%M:%S")
-                end_time = extracted_time + timedelta(hours=end_time_steps)
-                end_time = end_time .strftime("%Y-%m-%d %H:%M:%S")
+                start, stop, reference_time, start_time, end_time = \
+                    extract_from_d3d_files.mdf_time_frame(mdf_file)
 
                 # Output files
                 name_with_dot = mdf_file.partition('.')
@@ -982,17 +884,6 @@ class Application(tk.Tk):
 
                 step_wave = step_number(step_w)
 
-                def value_from_txt_file(file, string_name):
-                    file1 = open(file, "r")
-                    for line in file1:
-                        if '=' in line:
-                            if string_name in line:
-                                val = line.split('=')
-                                string_val = val[1].strip()
-                                break
-                    file1.close()
-                    return string_val
-
                 # Files
                 mdw_file = mdw_entry.get()
                 grid_wave_input = grdw_entry.get()
@@ -1162,17 +1053,6 @@ class Application(tk.Tk):
 
                 step_wave = step_number(step_w)
 
-                def value_from_txt_file(file, string_name):
-                    file1 = open(file, "r")
-                    for line in file1:
-                        if '=' in line:
-                            if string_name in line:
-                                val = line.split('=')
-                                string_val = val[1].strip()
-                                break
-                    file1.close()
-                    return string_val
-
                 # Files
                 mdw_file = mdw_entry.get()
                 grid_wave_input = grdw_entry.get()
@@ -1673,8 +1553,21 @@ class Application(tk.Tk):
                                          font='Times').pack(pady=5)
         output_filename_entry = tk.Entry(framedown, width=50)
         output_filename_entry.pack()
-        
 
+        workers_label = tk.Label(framedown, text="Number of workers reading the GRIB files in parallel:\n(optional)",
+                                 font='Times').pack(pady=5)
+        workers_entry = tk.Entry(framedown, width=50)
+        workers_entry.pack()
+
+        process_var = tk.BooleanVar()
+        process_check = tk.Checkbutton(
+            framedown, text="Regrid whole months in separate processes", variable=process_var)
+        process_check.pack(pady=5)
+
+        cache_var = tk.BooleanVar()
+        cache_check = tk.Checkbutton(
+            framedown, text="Keep the regridded fields for later runs", variable=cache_var)
+        cache_check.pack(pady=5)
 
         text = """
         The main path containing the COSMO files should be structured as follows:\n\nFolder 1 should be named UV and should have all the U and V monthly cosmo grib files you wish to extract from.
@@ -1683,7 +1576,8 @@ class Application(tk.Tk):
         \nPlease make sure there is a time gap between the start of your PS,U,V data and the reference date
         \nThe COSMO files can be found at:
         \nhttps://opendata.dwd.de/climate_environment/REA/COSMO_REA6/hourly/2D/ 
-        \nOn the webpage look for PS, U_10M and V_10M and download all monthly files necesssary and unzip them - use 7-Zip. Delete the zip files before generating the wind field files."""
+        \nOn the webpage look for PS, U_10M and V_10M and download all monthly files necesssary and unzip them - use 7-Zip. Delete the zip files before generating the wind field files.
+        \nKept regridded fields are stored in the grib_index folder of the main path, delete its regridded folder to clear them."""
 
         permanent_text_label = tk.Label(
             frameright, text=text, justify=tk.LEFT, wraplength=400, font=('Times', 12))
@@ -1700,6 +1594,9 @@ class Application(tk.Tk):
             elif not ref_time_entry.get():
                 messagebox.showwarning(
                     "Warning", "Please provide the reference time.")
+            elif workers_entry.get().strip() and not workers_entry.get().strip().isdigit():
+                messagebox.showwarning(
+                    "Warning", "The number of workers should be a whole number.")
             else:
                 # Input files
                 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -1709,9 +1606,13 @@ class Application(tk.Tk):
                 cosmo_files_path = cosmo_file_path_entry.get()
                 file_name = output_filename_entry.get()
                 ref_time = ref_time_entry.get()
+                workers = int(workers_entry.get()) if workers_entry.get().strip() else None
+                executor = 'process' if process_var.get() else 'thread'
 
-                # Delete .idx files before starting the process
+                # Delete .idx files before starting the process, the index cache of the
+                # generator checks its files against the GRIB files itself
                 for root, dirs, files in os.walk(cosmo_files_path):
+                    dirs[:] = [d for d in dirs if d != cosmo_methods.GRIB_INDEX_DIR]
                     for file in files:
                         if file.endswith('.idx'):
                             os.remove(os.path.join(root, file))
@@ -1720,7 +1621,10 @@ class Application(tk.Tk):
                                                                    cosmo_db_utm_path,
                                                                    cosmo_files_path,
                                                                    file_name,
-                                                                   ref_time)
+                                                                   ref_time,
+                                                                   workers=workers,
+                                                                   executor=executor,
+                                                                   cache=cache_var.get())
 
                 print('S-T varying wind field file have been generated')
                 elapsed_final = (time.time() - t) / 60
@@ -1746,5 +1650,7 @@ class Application(tk.Tk):
 
 if __name__ == "__main__":
 
+    # Needed by the frozen executable when extraction runs on a process pool
+    multiprocessing.freeze_support()
     app = Application()
     app.mainloop()
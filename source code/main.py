@@ -1,12 +1,11 @@
 import warnings
-from datetime import timedelta
-from datetime import datetime
 import sea_level_change
 import mdw_writer
 import bcw_year_overlap_file_generator
 import bcw_generator
 import bct_year_overlap_file_generator
 import bct_generator
+import bct_bcw_generator
 import time
 import os
 import extract_from_d3d_files
@@ -14,6 +13,7 @@ import output_methods
 import rep_period
 import plot_windroses
 import cosmo_wind_file_generator
+import cosmo_methods
 import ast
 """RUN THIS FILE"""
 # %% import modules
@@ -39,9 +39,9 @@ if __name__ == '__main__':
     print('Types of files offered:',
           'For all files, type 1',
           'For bct file, type 2',
-          'For bct file overlapping over two years, type 3',
+          'For bct file overlapping over two or more years, type 3',
           'For bcw file, type 4',
-          'For bcw file overlapping over two years, type 5',
+          'For bcw file overlapping over two or more years, type 5',
           'For boundary location csv file, type 6',
           'For boundary location and mdw file, type 7',
           'For adding sea level change to .bct files, type 8',
@@ -57,21 +57,6 @@ if __name__ == '__main__':
     choice = float(req)
     # %% CHOICE 1
     if choice == 1:
-        # load time extracting function
-        def value_from_txt_file(file, string_name):
-            file1 = open(file, "r")
-            for line in file1:
-                # checking string is present in line or not
-                if '=' in line:
-                    if string_name in line:
-                        val = line.split('=')
-                        string_val = val[1].strip()
-                        break
-                        file1.close()  # close file
-                    # else:
-                        # print('{} is not in the file'.format(string_name))
-            return string_val
-
         print("Please read carefully the input criteria,",
               "some requests are for the wave grid while some for flow")
 
@@ -106,35 +91,12 @@ if __name__ == '__main__':
         step = float(step_req)
 
         step_wave_req = input(
-            'Enter time step to extract WAVE data (max resolution is 20 mins, should be multiples of 20) format- 20 : ')
+            'Enter time step to extract WAVE data (any step, steps that are not multiples of 20 mins are interpolated) format- 20 : ')
         step_wave = float(step_wave_req)
 
         # Extract start and end time from mdf file
-        string1 = 'Tstart'
-        tstart_val = value_from_txt_file(file=mdf_file, string_name=string1)
-        string2 = 'Tstop'
-        tstop_val = value_from_txt_file(file=mdf_file, string_name=string2)
-        string3 = 'Itdate'  # reference time
-        ref_time_unedited = value_from_txt_file(
-            file=mdf_file, string_name=string3)
-        start = float(tstart_val)  # from mdf file
-        stop = float(tstop_val)  # from mdf file
-        ref_time = ref_time_unedited[1:11]
-        # remove the hyphen for the bct file format
-        reference_time = ref_time.replace('-', '')
-        # extract start time and end time from mdf
-        time_start = ref_time+" 00:00:00"  # Assuming it always starts at 00
-        date_format_str = "%Y-%m-%d %H:%M:%S"
-        # Calculate number of hours between ref time and sim time
-        start_time_steps = int(start/60)  # to convert minutes to hours
-        end_time_steps = int(stop/60)
-        # create datetime object from timestamp string
-        extracted_time = datetime.strptime(time_start, date_format_str)
-        start_time = extracted_time + timedelta(hours=start_time_steps)
-        # Convert datetime object to string in specific format
-        start_time = start_time .strftime("%Y-%m-%d %H:%M:%S")
-        end_time = extracted_time + timedelta(hours=end_time_steps)
-        end_time = end_time .strftime("%Y-%m-%d %H:%M:%S")
+        start, stop, reference_time, start_time, end_time = \
+            extract_from_d3d_files.mdf_time_frame(mdf_file)
         print('.')
         print('.')
         print('.')
@@ -191,29 +153,18 @@ if __name__ == '__main__':
         print('The process of creating',
               ' the boundary location csv file for Wave is completed - 4 of 6')
 
-        # %% Create the bct file
+        # %% Create the bct and bcw files in one joint run
         boundaries = path_out_file  # the csv file generated from process one
-        bct = bct_generator.bct_file_generator(
-            boundaries=boundaries, nc_file=nc_file, mdf_file=mdf_file, step=step,
-            bct_file_name=bct_file_name)
-
-        t_2 = time.time()
+        boundaries_wave = wave_path_out_file
+        bct_bcw_generator.bct_bcw_file_generator(
+            boundaries=boundaries, boundaries_wave=boundaries_wave, nc_file=nc_file,
+            nc_file_wave=nc_file_wave, mdf_file=mdf_file, mdw_file=mdw_file, step=step,
+            step_wave=step_wave, bct_file_name=bct_file_name, bcw_file_name=bcw_file)
 
         # %% end the time counter
         print('.')
-        print('The process of extracting water level has now completed in : ')
+        print('The process of extracting water level and wave boundary conditions has now completed in : ')
         elapsed = time.time() - t
-        print(str(elapsed) + " sec - 5 of 6")
-
-        # %% Create the bcw file
-        boundaries_wave = wave_path_out_file
-        bcw = bcw_generator.bcw_file_generator(
-            boundaries_wave=boundaries_wave, nc_file_wave=nc_file_wave, mdw_file=mdw_file, start_time=start_time,
-            end_time=end_time, step_wave=step_wave, bcw_file_name=bcw_file)
-
-        print('.')
-        print('The process of extracting wave boundary conditions has now completed in : ')
-        elapsed = time.time() - t_2
         print(str(elapsed) + " sec - 6 of 6")
         print('.')
         print('.')
@@ -289,11 +240,10 @@ if __name__ == '__main__':
         bnd_req = input('Enter name of the Flow bnd file : ')
         bnd_input = bnd_req
 
-        nc_file_req = input('Enter the NetCDF file name for year 1 : ')
-        nc_file = nc_file_req  # '2015_1000m_waterlevel_2D.nc'
-
-        nc_file_req_2 = input('Enter the NetCDF file name for year 2 : ')
-        nc_file_2 = nc_file_req_2  # '2015_1000m_waterlevel_2D.nc'
+        nc_file_req = input(
+            'Enter the NetCDF file names in chronological order, separated by commas : ')
+        # '2015_1000m_waterlevel_2D.nc, 2016_1000m_waterlevel_2D.nc'
+        nc_files = [nc_file.strip() for nc_file in nc_file_req.split(',')]
 
         mdf_file_req = input('Enter the mdf file name : ')
         mdf_file = mdf_file_req  # 'test.mdf'
@@ -329,9 +279,8 @@ if __name__ == '__main__':
 
         # %% Create the bct file
         boundaries = path_out_file  # the csv file generated from process one
-        bct = bct_year_overlap_file_generator.bct_year_overlap_file_generator(
-            boundaries=boundaries, nc_file_year1=nc_file,
-            nc_file_year2=nc_file_2, mdf_file=mdf_file, step=step,
+        bct = bct_year_overlap_file_generator.bct_multi_year_file_generator(
+            boundaries=boundaries, nc_files=nc_files, mdf_file=mdf_file, step=step,
             bct_file_name=bct_file_name)
 
         # %% end the time counter
@@ -364,7 +313,7 @@ if __name__ == '__main__':
         end_time = end_time_req  # '2015-03-14 00:00:00'
 
         step_wave_req = input(
-            'Enter time step to extract WAVE data (max resolution is 20mins, should be multiples of 20) format 20 : ')
+            'Enter time step to extract WAVE data (any step, steps that are not multiples of 20mins are interpolated) format 20 : ')
 
         # 2.0000000e+001  # 20 minute step # max resolution for gsh data
         step_wave = float(step_wave_req)
@@ -424,11 +373,10 @@ if __name__ == '__main__':
         bnd_wave_req = input('Enter name of the Wave bnd file : ')
         bnd_wave_input = bnd_wave_req
 
-        nc_file_wave_req = input('Enter the NetCDF file name for year 1 : ')
-        nc_file_wave = nc_file_wave_req  # '2015_1000m_wave_2D.nc'
-
-        nc_file_wave_req_2 = input('Enter the NetCDF file name for year 2: ')
-        nc_file_wave_2 = nc_file_wave_req_2  # '2015_1000m_wave_2D.nc'
+        nc_file_wave_req = input(
+            'Enter the NetCDF file names in chronological order, separated by commas : ')
+        # '2015_1000m_wave_2D.nc, 2016_1000m_wave_2D.nc'
+        nc_files_wave = [nc_file.strip() for nc_file in nc_file_wave_req.split(',')]
 
         mdw_file_req = input('Enter the mdw file name : ')
         mdw_file = mdw_file_req  # 'test.mdw'
@@ -442,7 +390,7 @@ if __name__ == '__main__':
         end_time = end_time_req  # '2015-03-14 00:00:00'
 
         step_wave_req = input(
-            'Enter time step to extract WAVE data (max resolution is 20mins, should be multiples of 20) format 20 : ')
+            'Enter time step to extract WAVE data (any step, steps that are not multiples of 20mins are interpolated) format 20 : ')
 
         # 2.0000000e+001  # 20 minute step # max resolution for gsh data
         step_wave = float(step_wave_req)
@@ -478,10 +426,9 @@ if __name__ == '__main__':
 
         # %% Create the bcw file
         boundaries_wave = wave_path_out_file
-        bcw = bcw_year_overlap_file_generator.bcw_year_overlap_file_generator(
-            boundaries_wave=boundaries_wave, nc_file_wave_year1=nc_file_wave,
-            nc_file_wave_year2=nc_file_wave_2,     mdw_file=mdw_file, start_time=start_time,
-            end_time=end_time, step_wave=step_wave, bcw_file_name=bcw_file)
+        bcw = bcw_year_overlap_file_generator.bcw_multi_year_file_generator(
+            boundaries_wave=boundaries_wave, nc_files_wave=nc_files_wave, mdw_file=mdw_file,
+            start_time=start_time, end_time=end_time, step_wave=step_wave, bcw_file_name=bcw_file)
         print('.')
         print(
             'The process of extracting wave boundary conditions has now completed in : ')
@@ -670,14 +617,34 @@ if __name__ == '__main__':
         ref_time = input(
             "\nReference time: \nShould be same as your model reference date\n\nPlease make sure there is a time gap between the start of your PS,U,V data and the reference date\neg YYYY-MM-DD hh:mm:ss  :")
 
+        start_time = input(
+            "\nStart time of the wind fields, leave empty to use all COSMO files\neg YYYY-MM-DD hh:mm:ss  :")
+
+        end_time = input(
+            "\nEnd time of the wind fields, leave empty to use all COSMO files\neg YYYY-MM-DD hh:mm:ss  :")
+
         output_file_name = input(
             "\n\nOutput file name \neg: cosmo_2011 :")
 
+        workers_req = input(
+            "\nNumber of workers reading the GRIB files in parallel, leave empty to read them one after the other :")
+        workers = int(workers_req) if workers_req.strip() else None
+
+        executor_req = input(
+            "\nType process to regrid whole months in separate processes, leave empty to use threads :")
+        executor = 'process' if executor_req.strip().lower() == 'process' else 'thread'
+
+        cache_req = input(
+            "\nType y to keep the regridded fields for later runs (cached in the grib_index folder), leave empty to skip :")
+        cache = cache_req.strip().lower() == 'y'
+
         db_file = f'{cosmo_path_req}\DB_6km.mat'
         cosmo_db_file = f'{cosmo_path_req}\COSMO_DB_UTM.mat'
 
-        # Delete .idx files before starting the process
+        # Delete .idx files before starting the process, the index cache of the
+        # generator checks its files against the GRIB files itself
         for root, dirs, files in os.walk(cosmo_path_req):
+            dirs[:] = [d for d in dirs if d != cosmo_methods.GRIB_INDEX_DIR]
             for file in files:
                 if file.endswith('.idx'):
                     os.remove(os.path.join(root, file))
@@ -686,7 +653,12 @@ if __name__ == '__main__':
                                                            cosmo_db_file,
                                                            cosmo_path_req,
                                                            output_file_name,
-                                                           ref_time)
+                                                           ref_time,
+                                                           start_time=start_time,
+                                                           end_time=end_time,
+                                                           workers=workers,
+                                                           executor=executor,
+                                                           cache=cache)
 
     else:
         print("You probably din't insert the number right, Please run again! ")
@@ -1,4 +1,9 @@
 import csv
+import os
+import queue
+import shutil
+import threading
+import numpy as np
 import extract_from_d3d_files
 
 
@@ -43,3 +48,178 @@ def write_grd_to_gis(path_grd, out_path):
                 m_index += 1
 
     print('ASCII file of boundary coordinates created.')
+
+
+def convert_flt_to_sci_not(fltt, prec, exp_digits):
+    """Format a float in scientific notation with a fixed number of exponent digits."""
+    s = "%.*e" % (prec, fltt)
+    if s == 'nan':
+        s = "%.*e" % (prec, 0)
+    mantissa, exp = s.split('e')
+    # add 1 to digits as 1 is taken by sign +/-
+    return "%se%+0*d" % (mantissa, exp_digits + 1, int(exp))
+
+
+def format_sci_not_rows(columns, prec=7, exp_digits=3, line_end='\r\n'):
+    """Format equally long columns of floats as rows of Delft3D scientific notation.
+    Positive values get a leading blank and NaN is written as zero."""
+    block = np.column_stack(columns).astype('float64')
+    block[np.isnan(block)] = 0
+    n_rows, n_cols = block.shape
+
+    # Python writes two exponent digits, pad them in one go unless a value needs three
+    magnitude = np.abs(block)
+    needs_fallback = ((magnitude >= 1e99) | ((magnitude < 1e-98) & (block != 0))).any()
+    if exp_digits >= 2 and not needs_fallback:
+        row_fmt = ' '.join(['% .{}e'.format(prec)] * n_cols) + line_end
+        text = (row_fmt * n_rows) % tuple(block.ravel())
+        pad = '0' * (exp_digits - 2)
+        return text.replace('e+', 'e+' + pad).replace('e-', 'e-' + pad)
+
+    rows = []
+    for row in block:
+        values = [convert_flt_to_sci_not(fltt=flt, prec=prec, exp_digits=exp_digits) for flt in row]
+        rows.append(' '.join(val if val[:1] == '-' else f' {val}' for val in values))
+    return line_end.join(rows) + line_end
+
+
+def write_bct_file(bct_file_name, sections, reference_time, time_values):
+    """Write a bct file with one buffered write per boundary section.
+    sections holds (boundary name, water level end A, water level end B) per boundary."""
+    record_in_table = len(time_values)
+
+    with open(bct_file_name, 'w', newline='') as f:
+        for section_number, (bn_name, wl_a, wl_b) in enumerate(sections, start=1):
+            header_lines = ["table-name           'Boundary Section : {}'".format(section_number),
+                            "contents             'Uniform             '",
+                            "location             '{}              '".format(
+                                bn_name),
+                            "time-function        'non-equidistant'",
+                            "reference-time       {}".format(reference_time),
+                            "time-unit            'minutes'",
+                            "interpolation        'linear'",
+                            "parameter            'time                '                     unit '[min]'",
+                            "parameter            'water elevation (z)  end A'               unit '[m]'",
+                            "parameter            'water elevation (z)  end B'               unit '[m]'",
+                            "records-in-table     {}".format(record_in_table)]
+
+            rows = format_sci_not_rows(
+                [time_values, wl_a[:record_in_table], wl_b[:record_in_table]])
+            f.write('\r\n'.join(header_lines) + '\r\n' + rows)
+
+
+def format_fixed_rows(columns, widths, decimals, line_end='\n'):
+    """Format equally long columns of floats as blank separated fixed width rows.
+    Every column has its own width and number of decimals, the whole block is formatted at once."""
+    block = np.column_stack(columns).astype('float64')
+    row_fmt = ' '.join('%{}.{}f'.format(width, decimal)
+                       for width, decimal in zip(widths, decimals)) + line_end
+
+    return (row_fmt * block.shape[0]) % tuple(block.ravel())
+
+
+def write_bcw_file(bcw_file_name, sections, reference_date, time_values, time_stop, chunk_size=50000):
+    """Write a bcw file to one open handle.
+
+    sections is any iterable, e.g. a generator, of (location name, wave height, period, direction,
+    directional spreading), so sections can be written as soon as they are extracted.
+    Rows are formatted in blocks of chunk_size records to keep the strings small."""
+    time_values = np.asarray(time_values, dtype='float64')
+    # integral digits of the time column follow the last time of the file
+    time_width = len(str(float(time_stop)).split('.')[0]) + 3
+    widths = [time_width, 7, 7, 9, 8]
+    decimals = [2, 4, 4, 4, 4]
+
+    with open(bcw_file_name, 'w', newline='') as f:
+        for location, sig_height, peak_period, direction, dir_spread in sections:
+            header_lines = [
+                "location             '{}                 '".format(location),
+                "time-function        'non-equidistant'",
+                "reference-time       {}".format(reference_date),
+                "time-unit            'minutes'",
+                "interpolation        'linear'",
+                "parameter            'time                  '                   unit '[min]'",
+                "parameter            'WaveHeight'                               unit '[m]'",
+                "parameter            'Period'                                   unit '[s]'",
+                "parameter            'Direction'                                unit '[N^o]'",
+                "parameter            'DirSpreading'                             unit '[deg]'"]
+            f.write('\n'.join(header_lines) + '\n')
+
+            for first in range(0, len(time_values), chunk_size):
+                last = first + chunk_size
+                f.write(format_fixed_rows(
+                    [time_values[first:last], sig_height[first:last], peak_period[first:last],
+                     direction[first:last], dir_spread[first:last]], widths, decimals))
+
+
+def format_meteo_field(field):
+    """Format one meteo_on_equidistant_grid field shaped (grid rows, grid columns) at once,
+    the first column 6 wide and the others 7 wide, all with two decimals."""
+    field = np.asarray(field, dtype='float64')
+    n_cols = field.shape[1]
+    return format_fixed_rows(field.T, [6] + [7] * (n_cols - 1), [2] * n_cols)
+
+
+def format_meteo_steps(streams, time_lines, fields):
+    """Format time steps of meteo fields into one block of text per output file.
+
+    fields maps a field name to an array shaped (time, grid rows, grid columns) and streams
+    maps every output file key to the field it holds. Each field is formatted once per step
+    and the text is shared by all outputs of that field, e.g. the .amu and xwind_ files."""
+    blocks = {key: [] for key in streams}
+    for kk, time_line in enumerate(time_lines):
+        text = {name: format_meteo_field(values[kk]) for name, values in fields.items()}
+        for key, name in streams.items():
+            blocks[key].append(time_line + '\n' + text[name])
+
+    return {key: ''.join(block) for key, block in blocks.items()}
+
+
+def write_meteo_blocks(files, blocks, max_blocks=2):
+    """Write blocks of formatted steps {file key: text} to the open files from a writer thread.
+
+    blocks is any iterable, e.g. a generator that reads, regrids and formats the next GRIB files
+    while the previous block is still being written. Blocks are written in the order they come
+    and at most max_blocks of them wait in the bounded queue, so memory stays flat."""
+    pending = queue.Queue(maxsize=max_blocks)
+    errors = []
+
+    def drain():
+        while True:
+            block = pending.get()
+            if block is None:
+                return
+            if errors:
+                continue
+            try:
+                for key, text in block.items():
+                    files[key].write(text)
+            except Exception as err:
+                errors.append(err)
+
+    writer = threading.Thread(target=drain, daemon=True)
+    writer.start()
+    try:
+        for block in blocks:
+            if errors:
+                break
+            pending.put(block)
+    finally:
+        pending.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+
+def merge_meteo_segments(files, streams, segments):
+    """Append segment files of formatted steps to the open output files in the given order.
+
+    segments is any iterable of {field name: segment file}; streams maps every output file key
+    to the field it holds. Each segment file is removed once it has been copied."""
+    for segment in segments:
+        for key, name in streams.items():
+            with open(segment[name], 'r') as f:
+                shutil.copyfileobj(f, files[key], 1024 * 1024)
+        for path in segment.values():
+            os.remove(path)